@@ -1,16 +1,25 @@
 import streamlit as st
 import requests
-from google.transit import gtfs_realtime_pb2
-import folium
-from folium.plugins import MarkerCluster
+from requests.adapters import HTTPAdapter
 from google.protobuf.json_format import MessageToDict
+from google.protobuf.internal import api_implementation
 import json
-from streamlit_folium import folium_static
+import orjson
 import pandas as pd
+import numpy as np
 from datetime import datetime
 from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
 import io
+import keyword
+import uuid
+import threading
+from functools import partial
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Set initial page config
 st.set_page_config(page_title="GTFS Inspector", layout="wide", page_icon=":bus:")
@@ -28,17 +37,29 @@ st.markdown(
 )
 
 map_size = 500
+json_page_size = 100
+
+# Feed parsing leans on protobuf's compiled backend (upb, the default since protobuf 4.21)
+if api_implementation.Type() == 'python':
+    st.warning("protobuf is using its pure-Python implementation, so loading large feeds will be slow. Install protobuf>=4.21 to get the compiled backend.")
 
 # GCS Configuration
 @st.cache_resource
 def get_gcs_client():
     credentials_info = st.secrets["gcp_service_account"]
     credentials = service_account.Credentials.from_service_account_info(credentials_info)
-    return storage.Client(credentials=credentials)
+    # Authorized session with a keep-alive pool, so GCS calls across reruns reuse their TLS connections
+    # (scoped here: storage.Client only scopes the credentials of the session it builds itself)
+    http = AuthorizedSession(credentials.with_scopes(storage.Client.SCOPE))
+    http.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
+    return storage.Client(credentials=credentials, _http=http)
+
+# Bucket handle, built once per process alongside the client rather than on every rerun
+@st.cache_resource
+def get_gcs_bucket():
+    return get_gcs_client().bucket(st.secrets["bucket"]["gcs_bucket_name"])
 
-gcs_client = get_gcs_client()
-bucket_name = st.secrets["bucket"]["gcs_bucket_name"]
-bucket = gcs_client.bucket(bucket_name)
+bucket = get_gcs_bucket()
 
 # Function to upload or update a network file in GCS
 def upload_or_update_network_file(network_name, content):
@@ -48,13 +69,20 @@ def upload_or_update_network_file(network_name, content):
     except Exception as e:
         st.error(f"Error uploading network file '{network_name}': {e}")
 
-# Function to download a network file from GCS
-def download_network_file(network_name):
+# Function to read a network file from GCS (cached: definitions rarely change, and edits clear it)
+# Errors other than NotFound propagate, so st.cache_data does not keep them and the next rerun retries
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_network_file(network_name):
     blob = bucket.blob(f"{network_name}.json")
     try:
-        if not blob.exists():
-            return None
         return blob.download_as_text()
+    except NotFound:
+        return None
+
+# Function to download a network file from GCS
+def download_network_file(network_name):
+    try:
+        return fetch_network_file(network_name)
     except Exception as e:
         st.error(f"Error downloading network file '{network_name}': {e}")
         return None
@@ -63,150 +91,448 @@ def download_network_file(network_name):
 def delete_network_file(network_name):
     blob = bucket.blob(f"{network_name}.json")
     try:
-        if blob.exists():
-            blob.delete()
-            return True
-        else:
-            st.error(f"Network file '{network_name}' not found.")
-            return False
+        blob.delete()
+        return True
+    except NotFound:
+        st.error(f"Network file '{network_name}' not found.")
+        return False
     except Exception as e:
         st.error(f"Error deleting network file '{network_name}': {e}")
         return False
 
+# Function to read the network names from GCS (cached: definitions rarely change; errors are not cached)
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_network_names():
+    return [blob.name.replace('.json', '') for blob in bucket.list_blobs(match_glob='**.json')]
+
 # Function to list network files in GCS
 def list_network_files():
     try:
-        return [blob.name.replace('.json', '') for blob in bucket.list_blobs() if blob.name.endswith('.json')]
+        return fetch_network_names()
     except Exception as e:
         st.error(f"Error listing network files: {e}")
         return []
 
-# Load network list into session state
-def load_network_list():
-    if 'network_list' not in st.session_state:
-        st.session_state['network_list'] = list_network_files()
-    return st.session_state['network_list']
-
-def clear_network_session_state():
-    if 'network_list' in st.session_state:
-        del st.session_state['network_list']
+# Function to drop the cached network list and definitions after a change, then rerun
+def refresh_network_files():
+    fetch_network_names.clear()
+    fetch_network_file.clear()
     st.rerun()
 
-# Function to open GTFS real-time data from URL
-def open_gtfs_realtime_from_url(url):
-    try:
-        feed = gtfs_realtime_pb2.FeedMessage()
-        response = requests.get(url)
-        response.raise_for_status()
-        feed.ParseFromString(response.content)
-        return feed
-    except Exception as e:
-        st.error(f"Error opening GTFS RT URL: {e}")
-        return None
+# Seconds to wait for a feed server before giving up
+FEED_TIMEOUT = 15
 
-# Function to flatten nested dictionaries (protobuf)
-def flatten_dict(d, parent_key='', sep='_'):
-    items = []
-    for k, v in d.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(flatten_dict(v, new_key, sep=sep).items())
+# Shared HTTP session: keeps connections to the feed servers alive between loads
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # requests decompresses gzip bodies transparently
+    session.headers['Accept-Encoding'] = 'gzip'
+    return session
+
+# Number of feed URLs whose validators and last download are kept, least recently used dropped first
+FEED_VALIDATOR_ENTRIES = 32
+
+# Validators (ETag / Last-Modified) and bytes of the last download of each feed URL, shared by all
+# sessions (the lock guards it against the concurrent feed fetches)
+@st.cache_resource
+def get_feed_validators():
+    return OrderedDict(), threading.Lock()
+
+# Function to download a GTFS RT feed, revalidating the previous copy with a conditional GET
+def download_feed_content(url):
+    validators, lock = get_feed_validators()
+    with lock:
+        previous = validators.get(url)
+    headers = {}
+    if previous:
+        if previous['etag']:
+            headers['If-None-Match'] = previous['etag']
+        if previous['last_modified']:
+            headers['If-Modified-Since'] = previous['last_modified']
+    # Streamed so a 304 answer returns without reading a body
+    with get_http_session().get(url, headers=headers, stream=True, timeout=FEED_TIMEOUT) as response:
+        if response.status_code == 304 and previous:
+            content = previous['content']
         else:
-            items.append((new_key, v))
-    return dict(items)
+            response.raise_for_status()
+            content = response.content
+            previous = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'content': content
+            }
+    with lock:
+        validators[url] = previous
+        validators.move_to_end(url)
+        while len(validators) > FEED_VALIDATOR_ENTRIES:
+            validators.popitem(last=False)
+    return content
+
+# Function to parse GTFS real-time data
+def parse_gtfs_realtime(content):
+    from google.transit import gtfs_realtime_pb2
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    return feed
+
+# Function to download a GTFS RT feed
+# st.cache_data is global: every session loading the same URL within the TTL shares one download
+# (max_entries bounds memory when many networks are inspected)
+@st.cache_data(ttl=15, max_entries=32, show_spinner=False)
+def fetch_feed_content(url):
+    return download_feed_content(url)
+
+# Function to build the dataframe of a downloaded feed
+# Sessions only keep the compact protobuf bytes; st.cache_resource hands every rerun and every session
+# the same frame for the same bytes, so it is parsed once per feed version and keeps its load_id
+@st.cache_resource(max_entries=32, show_spinner=False)
+def feed_dataframe(content):
+    df = pd.DataFrame() if content is None else protobuf_to_dataframe(parse_gtfs_realtime(content))
+    # Identity of this frame for the filter caches (see hash_loaded_data)
+    df.attrs['load_id'] = uuid.uuid4().hex
+    df.attrs['load_rows'] = len(df)
+    return df
+
+# Function to download and parse a feed on a worker thread, with this session's script context attached
+def submit_feed_fetch(executor, url):
+    ctx = get_script_run_ctx()
+
+    def fetch():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        content = fetch_feed_content(url)
+        feed_dataframe(content)
+        return content
+
+    return executor.submit(fetch)
+
+def _is_repeated(field):
+    # FieldDescriptor.label was replaced by is_repeated in recent protobuf releases
+    return field.is_repeated if hasattr(field, 'is_repeated') else field.label == field.LABEL_REPEATED
+
+# Function to generate a flattener specialized for one protobuf message type
+# The emitted code is straight HasField checks and attribute reads along every field path of the schema,
+# writing each set field into columns[column_name][row] (the same pairs a ListFields() walk would give).
+# Repeated and recursive sub-messages are taken from message_dict (the MessageToDict of the same message)
+# rather than converted a second time.
+def compile_flattener(descriptor, sep='_'):
+    lines = ["def flatten(message, message_dict, columns, row):"]
+    namespace = {}
+
+    def emit(message_descriptor, var, parent_key, depth, path, json_path):
+        pad = '    ' * depth
+        # Field number order, as ListFields() and MessageToDict use
+        for field in sorted(message_descriptor.fields, key=lambda f: f.number):
+            # json_name gives the camelCase names the filters expect ("tripUpdate_trip_tripId")
+            new_key = f"{parent_key}{sep}{field.json_name}" if parent_key else field.json_name
+            attr = f"getattr({var}, {field.name!r})" if keyword.iskeyword(field.name) else f"{var}.{field.name}"
+            dict_value = "message_dict" + "".join(f"[{key!r}]" for key in json_path + (field.json_name,))
+            if _is_repeated(field):
+                value = dict_value if field.type == field.TYPE_MESSAGE else f"list({attr})"
+                lines.append(f"{pad}if {attr}:")
+                lines.append(f"{pad}    columns[{new_key!r}][row] = {value}")
+                continue
+            lines.append(f"{pad}if {var}.HasField({field.name!r}):")
+            if field.type == field.TYPE_MESSAGE and field.message_type not in path:
+                child = f"m{depth}"
+                lines.append(f"{pad}    {child} = {attr}")
+                emit(field.message_type, child, new_key, depth + 1, path + (field.message_type,), json_path + (field.json_name,))
+            elif field.type == field.TYPE_MESSAGE:
+                # Recursive message type: keep the nested part as a dict
+                lines.append(f"{pad}    columns[{new_key!r}][row] = {dict_value}")
+            elif field.type == field.TYPE_ENUM:
+                enum_names = f"ENUM_NAMES_{len(namespace)}"
+                namespace[enum_names] = {value.number: value.name for value in field.enum_type.values}
+                lines.append(f"{pad}    columns[{new_key!r}][row] = {enum_names}.get({attr}, {attr})")
+            elif field.type == field.TYPE_FLOAT:
+                # Taken from message_dict, which already holds the shortest float32 round-trip (48.79999923706055 -> 48.8)
+                lines.append(f"{pad}    columns[{new_key!r}][row] = {dict_value}")
+            else:
+                lines.append(f"{pad}    columns[{new_key!r}][row] = {attr}")
+
+    emit(descriptor, 'message', '', 1, (descriptor,), ())
+    exec('\n'.join(lines), namespace)
+    return namespace['flatten']
+
+# GTFS RT entity flattener, generated once per process
+@st.cache_resource
+def get_entity_flattener():
+    from google.transit import gtfs_realtime_pb2
+
+    return compile_flattener(gtfs_realtime_pb2.FeedEntity.DESCRIPTOR)
+
+# Function to export a dataframe as an XLSX workbook
+# (no constant_memory: that mode only accepts row-by-row writes and pandas writes column by column)
+def dataframe_to_xlsx(data):
+    towrite = io.BytesIO()
+    if 'original_json' in data.columns:
+        data = data.assign(original_json=[orjson.dumps(entity_dict).decode() for entity_dict in data['original_json']])
+    with pd.ExcelWriter(towrite, engine='xlsxwriter') as writer:
+        data.to_excel(writer, index=False, header=True)
+    return towrite.getvalue()
+
+# Id columns the filters look rows up by, stored as categoricals
+ID_COLUMNS = ['vehicle_vehicle_id', 'vehicle_trip_tripId', 'vehicle_trip_routeId', 'tripUpdate_vehicle_id', 'tripUpdate_trip_tripId', 'tripUpdate_trip_routeId']
+
+# Numeric columns, cast once at ingest (Int64 keeps rows without a timestamp)
+COLUMN_DTYPES = {'vehicle_position_latitude': 'float64', 'vehicle_position_longitude': 'float64', 'vehicle_timestamp': 'Int64'}
 
 # Function to convert GTFS protobuf feed to dataframe
 def protobuf_to_dataframe(feed):
-    rows = []
-    for entity in feed.entity:
+    flatten_entity = get_entity_flattener()
+    # Column-wise build: one list per field, filled in place, instead of a dict per row for pandas to align
+    n_rows = len(feed.entity)
+    columns = defaultdict(lambda: [None] * n_rows)
+    original_json = [None] * n_rows
+    for row, entity in enumerate(feed.entity):
+        # One MessageToDict per entity: kept as original_json (so the JSON view and download never
+        # re-parse it) and shared with the flattener for stopTimeUpdate-style lists
         entity_dict = MessageToDict(entity)
-        flattened_entity = flatten_dict(entity_dict)
-        flattened_entity['original_json'] = json.dumps(entity_dict)
-        rows.append(flattened_entity)
-    return pd.DataFrame(rows)
-
-def smart_sort(data):
-    if all(str(x).isdigit() for x in data):
-        # If all items are numeric, sort as integers
-        return sorted(data, key=int)
-    else:
-        # If items are mixed, sort as strings
-        return sorted(data, key=str)
-
-# Function to create a map
-@st.cache_resource
+        flatten_entity(entity, entity_dict, columns, row)
+        original_json[row] = entity_dict
+    columns['original_json'] = original_json
+    df = pd.DataFrame(columns)
+    # Native dtypes for the columns the map and filters work on, instead of boxed Python objects
+    df = df.astype({col: dtype for col, dtype in COLUMN_DTYPES.items() if col in df.columns})
+    for col in ID_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+def smart_sort(series):
+    values = np.asarray(series.dropna().unique(), dtype=object)
+    text = pd.Series(values, dtype=str)
+    digit_mask = text.str.fullmatch(r'\d+').to_numpy(dtype=bool)
+    # Numeric ids first, in numeric order: compared by length then text once leading zeros are
+    # stripped, so ids too long for int64 still sort correctly
+    digits = text[digit_mask].str.lstrip('0')
+    digit_order = np.lexsort((digits.to_numpy(dtype=str), digits.str.len().to_numpy()))
+    # Then every other id, sorted as strings
+    other_order = np.argsort(text[~digit_mask].to_numpy(dtype=str), kind='stable')
+    return values[digit_mask][digit_order].tolist() + values[~digit_mask][other_order].tolist()
+
+# Function to collect the sorted ids each filter offers (run once per load, not on every rerun)
+def build_filter_ids(vehicle_data, trip_data):
+    empty = pd.Series(dtype=object)
+    return {
+        "Vehicle ID": smart_sort(vehicle_data.get('vehicle_vehicle_id', empty)),
+        "Trip ID": smart_sort(pd.concat([vehicle_data.get('vehicle_trip_tripId', empty), trip_data.get('tripUpdate_trip_tripId', empty)])),
+        "Route ID": smart_sort(pd.concat([vehicle_data.get('vehicle_trip_routeId', empty), trip_data.get('tripUpdate_trip_routeId', empty)]))
+    }
+
+# The map shows every column except original_json (markers from the coordinates, popups from the rest,
+# in column order), so those columns are the cache key; original_json and its dicts are left out
+def hash_map_data(df):
+    key_data = df.drop(columns=['original_json'], errors='ignore')
+    # Hash list-valued columns by the text the popups show
+    key_data = key_data.apply(lambda col: col.astype(str) if col.dtype == object else col)
+    return tuple(key_data.columns), pd.util.hash_pandas_object(key_data, index=False).values.tobytes()
+
+# Leaflet factory used by FastMarkerCluster for each [lat, lon, popup] row
+MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(row[2], {maxWidth: 300});
+    return marker;
+}
+"""
+
+# Above this many vehicles, markers are clustered in the browser by Supercluster from a GeoJSON layer
+SUPERCLUSTER_THRESHOLD = 500
+
+# Leaflet script that clusters a GeoJSON FeatureCollection client-side with Supercluster,
+# only adding the clusters/markers visible in the current viewport to the DOM
+SUPERCLUSTER_TEMPLATE = """
+    {% macro script(this, kwargs) %}
+        (function () {
+            var map = {{ this._parent.get_name() }};
+            var index = new Supercluster({radius: 60, maxZoom: 16}).load({{ this.geojson }}.features);
+            var layer = L.geoJSON(null, {
+                pointToLayer: function (feature, latlng) {
+                    if (!feature.properties.cluster) {
+                        return L.marker(latlng).bindPopup(feature.properties.popup, {maxWidth: 300});
+                    }
+                    var count = feature.properties.point_count;
+                    var size = count < 100 ? 'small' : count < 1000 ? 'medium' : 'large';
+                    return L.marker(latlng, {icon: L.divIcon({
+                        html: '<div><span>' + feature.properties.point_count_abbreviated + '</span></div>',
+                        className: 'marker-cluster marker-cluster-' + size,
+                        iconSize: L.point(40, 40)
+                    })});
+                }
+            }).addTo(map);
+            layer.on('click', function (e) {
+                var clusterId = e.layer.feature.properties.cluster_id;
+                if (clusterId !== undefined) {
+                    map.setView(e.latlng, index.getClusterExpansionZoom(clusterId));
+                }
+            });
+            function update() {
+                var bounds = map.getBounds();
+                layer.clearLayers();
+                layer.addData(index.getClusters([bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()], map.getZoom()));
+            }
+            map.on('moveend', update);
+            update();
+        })();
+    {% endmacro %}
+"""
+
+# Function to create the Supercluster map layer
+# folium and its template machinery are imported here, on the first map render, instead of at startup
+def supercluster_layer(geojson):
+    from branca.element import MacroElement
+    from folium.elements import JSCSSMixin
+    from jinja2 import Template
+
+    class SuperclusterLayer(JSCSSMixin, MacroElement):
+        _template = Template(SUPERCLUSTER_TEMPLATE)
+
+        default_js = [
+            ("supercluster", "https://unpkg.com/supercluster@8.0.1/dist/supercluster.min.js")
+        ]
+        default_css = [
+            ("markerclustercss", "https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.css"),
+            ("markerclusterdefaultcss", "https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.Default.css")
+        ]
+
+        def __init__(self, geojson):
+            super().__init__()
+            self._name = "SuperclusterLayer"
+            self.geojson = geojson
+
+    return SuperclusterLayer(geojson)
+
+# Function to serialize vehicle positions as a compact GeoJSON FeatureCollection
+def build_geojson(latitudes, longitudes, popups):
+    features = [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]}, "properties": {"popup": popup}}
+        for lat, lon, popup in zip(latitudes, longitudes, popups)
+    ]
+    geojson = orjson.dumps({"type": "FeatureCollection", "features": features}).decode()
+    # Escape "<" so popup HTML can never close the surrounding <script> tag
+    return geojson.replace('<', '\\u003c')
+
+# Function to build the marker popup HTML of every vehicle with column-wise string operations
+def build_popups(vehicle_data):
+    formatted_time = None
+    if 'vehicle_timestamp' in vehicle_data.columns:
+        # Int64 keeps vehicles without a timestamp; they convert to NaT and show as such
+        formatted_time = pd.to_datetime(vehicle_data['vehicle_timestamp'], unit='s').dt.strftime('%Y-%m-%d %H:%M:%S').fillna('NaT')
+    lines = [
+        f"<b>{col.replace('vehicle_', '')}</b>: " + (formatted_time if col == 'vehicle_timestamp' else vehicle_data[col].astype(str).fillna('nan'))
+        for col in vehicle_data.columns if col != 'original_json'
+    ]
+    popups = lines[0].str.cat(lines[1:], sep='<br>')
+    return popups.str.replace('vehicle_vehicle_id', 'vehicle_id', regex=False).tolist()
+
+# Function to create a map, returned as rendered HTML (max_entries bounds the pages kept, as for feed_dataframe)
+@st.cache_data(max_entries=32, show_spinner=False, hash_funcs={pd.DataFrame: hash_map_data})
 def create_map(filtered_vehicle_data):
     # Drop rows with missing latitude and longitude values
     if 'vehicle_position_latitude' in filtered_vehicle_data.columns and 'vehicle_position_longitude' in filtered_vehicle_data.columns:
         filtered_vehicle_data = filtered_vehicle_data.dropna(subset=['vehicle_position_latitude', 'vehicle_position_longitude'])
 
-    if not filtered_vehicle_data.empty:
-        map_center = [filtered_vehicle_data['vehicle_position_latitude'].mean(), filtered_vehicle_data['vehicle_position_longitude'].mean()]
+    coordinates = filtered_vehicle_data[['vehicle_position_latitude', 'vehicle_position_longitude']].to_numpy(dtype=float)
+
+    if len(coordinates):
+        map_center = coordinates.mean(axis=0).tolist()
         zoom_level = 12
     else:
         map_center = [48.8566, 2.3522]  # Default location (e.g., Paris)
         zoom_level = 12
 
+    import folium
+    from folium.plugins import FastMarkerCluster
+
     m = folium.Map(location=map_center, zoom_start=zoom_level)
-    marker_cluster = MarkerCluster().add_to(m)
-    positions = []
-
-    for _, row in filtered_vehicle_data.iterrows():
-        position = [row['vehicle_position_latitude'], row['vehicle_position_longitude']]
-        positions.append(position)
-        vehicle_timestamp = int(row['vehicle_timestamp'])
-        formatted_time = datetime.utcfromtimestamp(vehicle_timestamp).strftime('%Y-%m-%d %H:%M:%S')
-        popup_content = '<br>'.join([
-            f"<b>{col.replace('vehicle_', '')}</b>: {formatted_time if col == 'vehicle_timestamp' else row[col]}"
-            for col in filtered_vehicle_data.columns if col != 'original_json'
-        ])
-        popup_content = popup_content.replace('vehicle_vehicle_id', 'vehicle_id')
-        folium.Marker(location=position, popup=folium.Popup(popup_content, max_width=300)).add_to(marker_cluster)
-
-    if positions:
-        m.fit_bounds(positions)
-    return m
-
-# Function to get filtered data
-@st.cache_data
+    latitudes, longitudes = coordinates.T.tolist()
+    popups = build_popups(filtered_vehicle_data)
+
+    if len(popups) > SUPERCLUSTER_THRESHOLD:
+        supercluster_layer(build_geojson(latitudes, longitudes, popups)).add_to(m)
+    else:
+        # Markers are built client-side from [lat, lon, popup] rows instead of one folium.Marker per vehicle
+        markers = [[lat, lon, popup] for lat, lon, popup in zip(latitudes, longitudes, popups)]
+        FastMarkerCluster(markers, callback=MARKER_CALLBACK).add_to(m)
+
+    if len(coordinates):
+        # Two corners are enough for fit_bounds
+        m.fit_bounds([coordinates.min(axis=0).tolist(), coordinates.max(axis=0).tolist()])
+    return m.get_root().render()
+
+# Function to fingerprint a loaded feed for the filter caches without hashing every cell, using the
+# load_id feed_dataframe stamps in its attrs. Only whole loaded frames may be passed: pandas copies attrs
+# into every slice, so two subsets of one feed would carry the same load_id
+def hash_loaded_data(df):
+    # A real check rather than an assert, so python -O cannot strip it
+    if 'load_id' not in df.attrs or df.attrs.get('load_rows') != len(df):
+        raise ValueError("The filter caches only take whole frames from feed_dataframe")
+    return df.attrs['load_id']
+
+# Function to index the rows of a loaded feed by id ({column: {id: row positions}}), built once per dataframe
+# (max_entries as for feed_dataframe: entries of evicted frames can never be hit again)
+@st.cache_data(max_entries=32, show_spinner=False, hash_funcs={pd.DataFrame: hash_loaded_data})
+def build_id_indexes(df):
+    return {col: df.groupby(col, sort=False, observed=True).indices for col in ID_COLUMNS if col in df.columns}
+
+# Function to select the rows whose id is one of ids, via hash lookups in an id index
+def select_rows(df, index, ids):
+    positions = [index[id_] for id_ in ids if id_ in index]
+    if not positions:
+        return df.iloc[0:0]
+    return df.iloc[np.sort(np.concatenate(positions))]
+
+# Function to get filtered data (bounded like build_id_indexes)
+@st.cache_data(max_entries=32, hash_funcs={pd.DataFrame: hash_loaded_data})
 def get_filtered_data(vehicle_data, trip_data, filter_option, selected_value):
-    # Create copies to avoid modifying the original data
-    filtered_vehicle_data = vehicle_data.copy()
-    filtered_trip_data = trip_data.copy()
+    # No filter: nothing to select (the caller skips this cached function entirely in that case)
+    if not selected_value:
+        return vehicle_data, trip_data
+
+    # Row selections below return new frames, so the inputs are never modified
+    filtered_vehicle_data = vehicle_data
+    filtered_trip_data = trip_data
+    vehicle_indexes = build_id_indexes(vehicle_data)
+    trip_indexes = build_id_indexes(trip_data)
 
     if filter_option == "Vehicle ID":
         # Filter by vehicle ID
         vehicle_id = selected_value
         if vehicle_id:
-            if 'vehicle_vehicle_id' in filtered_vehicle_data.columns:
-                filtered_vehicle_data = filtered_vehicle_data[filtered_vehicle_data['vehicle_vehicle_id'] == vehicle_id]
-            if 'tripUpdate_vehicle_id' in filtered_trip_data.columns:
-                filtered_trip_data = filtered_trip_data[filtered_trip_data['tripUpdate_vehicle_id'] == vehicle_id]
+            if 'vehicle_vehicle_id' in vehicle_indexes:
+                filtered_vehicle_data = select_rows(vehicle_data, vehicle_indexes['vehicle_vehicle_id'], [vehicle_id])
+            if 'tripUpdate_vehicle_id' in trip_indexes:
+                filtered_trip_data = select_rows(trip_data, trip_indexes['tripUpdate_vehicle_id'], [vehicle_id])
 
     elif filter_option == "Trip ID":
         # Filter by trip ID
         trip_id = selected_value
         if trip_id:
-            if 'tripUpdate_trip_tripId' in filtered_trip_data.columns:
-                filtered_trip_data = filtered_trip_data[filtered_trip_data['tripUpdate_trip_tripId'] == trip_id]
+            if 'tripUpdate_trip_tripId' in trip_indexes:
+                filtered_trip_data = select_rows(trip_data, trip_indexes['tripUpdate_trip_tripId'], [trip_id])
             # Get vehicle IDs associated with the trip from trip updates
-            vehicle_ids = filtered_trip_data['tripUpdate_vehicle_id'].dropna().unique().tolist() if 'tripUpdate_vehicle_id' in filtered_trip_data.columns else []
+            vehicle_ids = filtered_trip_data['tripUpdate_vehicle_id'].dropna().unique() if 'tripUpdate_vehicle_id' in filtered_trip_data.columns else []
             # Also include vehicle data for these vehicles
-            if vehicle_ids and 'vehicle_vehicle_id' in filtered_vehicle_data.columns:
-                filtered_vehicle_data = filtered_vehicle_data[filtered_vehicle_data['vehicle_vehicle_id'].isin(vehicle_ids)]
+            if len(vehicle_ids) and 'vehicle_vehicle_id' in vehicle_indexes:
+                filtered_vehicle_data = select_rows(vehicle_data, vehicle_indexes['vehicle_vehicle_id'], vehicle_ids)
             else:
                 # If vehicle IDs not found, try matching trip IDs in vehicle data
-                if 'vehicle_trip_tripId' in filtered_vehicle_data.columns:
-                    filtered_vehicle_data = filtered_vehicle_data[filtered_vehicle_data['vehicle_trip_tripId'] == trip_id]
+                if 'vehicle_trip_tripId' in vehicle_indexes:
+                    filtered_vehicle_data = select_rows(vehicle_data, vehicle_indexes['vehicle_trip_tripId'], [trip_id])
 
     elif filter_option == "Route ID":
         # Filter by route ID
         route_id = selected_value
         if route_id:
-            if 'vehicle_trip_routeId' in filtered_vehicle_data.columns:
-                filtered_vehicle_data = filtered_vehicle_data[filtered_vehicle_data['vehicle_trip_routeId'] == route_id]
-            if 'tripUpdate_trip_routeId' in filtered_trip_data.columns:
-                filtered_trip_data = filtered_trip_data[filtered_trip_data['tripUpdate_trip_routeId'] == route_id]
+            if 'vehicle_trip_routeId' in vehicle_indexes:
+                filtered_vehicle_data = select_rows(vehicle_data, vehicle_indexes['vehicle_trip_routeId'], [route_id])
+            if 'tripUpdate_trip_routeId' in trip_indexes:
+                filtered_trip_data = select_rows(trip_data, trip_indexes['tripUpdate_trip_routeId'], [route_id])
 
     return filtered_vehicle_data, filtered_trip_data
 
@@ -222,12 +548,12 @@ st.sidebar.header("Manage Sources")
 
 # Refresh Button
 if st.sidebar.button(":material/refresh: Refresh"):
-    clear_network_session_state()
+    refresh_network_files()
 
 action = st.sidebar.selectbox("Action", ["Add", "Modify", "Delete"], key="action")
 
 # Load network list
-network_list = load_network_list()
+network_list = list_network_files()
 
 # Action: Add
 if action == "Add":
@@ -242,13 +568,14 @@ if action == "Add":
                 "trip_updates_url": trip_updates_url
             }
             upload_or_update_network_file(name, json.dumps(network_data, indent=4))
-            clear_network_session_state()
+            refresh_network_files()
 
 # Action: Modify
 if action == "Modify":
     name_to_modify = st.sidebar.selectbox("Select Source to Modify", network_list)
     if name_to_modify:
-        network_data = json.loads(download_network_file(name_to_modify))
+        network_content = download_network_file(name_to_modify)
+        network_data = orjson.loads(network_content) if network_content else None
         if network_data:
             with st.sidebar.form("Modify Network"):
                 vehicle_positions_url = st.text_input("Vehicle Positions URL", network_data.get("vehicle_positions_url", ""))
@@ -260,7 +587,7 @@ if action == "Modify":
                         "trip_updates_url": trip_updates_url
                     }
                     upload_or_update_network_file(name_to_modify, json.dumps(network_data, indent=4))
-                    clear_network_session_state()
+                    refresh_network_files()
 
 # Action: Delete
 if action == "Delete":
@@ -268,10 +595,9 @@ if action == "Delete":
     if name_to_delete:
         if st.sidebar.button(f":material/delete: Delete {name_to_delete}"):
             delete_network_file(name_to_delete)
-            clear_network_session_state()
+            refresh_network_files()
 
 # Select GTFS RT
-network_list = load_network_list()
 if network_list:
     selected_name = st.selectbox("Select Source", network_list)
 else:
@@ -282,26 +608,36 @@ if st.button(f":material/system_update_alt: Load GTFS RT {selected_name}", use_c
     if selected_name:
         st.toast(":blue[:material/download:] Loading data...")
         try:
-            network_data = json.loads(download_network_file(selected_name))
+            network_content = download_network_file(selected_name)
+            network_data = orjson.loads(network_content) if network_content else None
             if not network_data:
                 st.toast(f":orange[:material/error:] No data found for network '{selected_name}'.")
             else:
-                vehicle_data, trip_data = pd.DataFrame(), pd.DataFrame()
-
-                if network_data.get("vehicle_positions_url"):
-                    vehicle_feed = open_gtfs_realtime_from_url(network_data["vehicle_positions_url"])
-                    if vehicle_feed:
-                        vehicle_data = protobuf_to_dataframe(vehicle_feed)
-                        st.toast(f":material/list: Vehicle data - Length: {len(vehicle_data)}")
-                if network_data.get("trip_updates_url"):
-                    trip_feed = open_gtfs_realtime_from_url(network_data["trip_updates_url"])
-                    if trip_feed:
-                        trip_data = protobuf_to_dataframe(trip_feed)
-                        st.toast(f":material/list: Trip updates - Length: {len(trip_data)}")
+                vehicle_feed, trip_feed = None, None
+
+                # The two feeds are independent downloads, so fetch them concurrently
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    vehicle_future = submit_feed_fetch(executor, network_data["vehicle_positions_url"]) if network_data.get("vehicle_positions_url") else None
+                    trip_future = submit_feed_fetch(executor, network_data["trip_updates_url"]) if network_data.get("trip_updates_url") else None
+
+                if vehicle_future:
+                    try:
+                        vehicle_feed = vehicle_future.result()
+                        st.toast(f":material/list: Vehicle data - Length: {len(feed_dataframe(vehicle_feed))}")
+                    except Exception as e:
+                        st.error(f"Error opening GTFS RT URL: {e}")
+                if trip_future:
+                    try:
+                        trip_feed = trip_future.result()
+                        st.toast(f":material/list: Trip updates - Length: {len(feed_dataframe(trip_feed))}")
+                    except Exception as e:
+                        st.error(f"Error opening GTFS RT URL: {e}")
 
                 fetch_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                st.session_state['vehicle_data'] = vehicle_data
-                st.session_state['trip_data'] = trip_data
+                # Only the raw feeds are kept per session; the dataframes come from feed_dataframe
+                st.session_state['vehicle_feed'] = vehicle_feed
+                st.session_state['trip_feed'] = trip_feed
+                st.session_state['filter_ids'] = build_filter_ids(feed_dataframe(vehicle_feed), feed_dataframe(trip_feed))
                 st.session_state['selected_name'] = selected_name
                 st.session_state['fetch_time'] = fetch_time
                 st.session_state['title'] = f"{selected_name} - {fetch_time}"
@@ -313,9 +649,10 @@ if st.button(f":material/system_update_alt: Load GTFS RT {selected_name}", use_c
             st.toast(f":orange[:material/error:] Error loading data for {selected_name}: {e}")
 
 # Display GTFS data
-if 'vehicle_data' in st.session_state and 'trip_data' in st.session_state and 'fetch_time' in st.session_state:
-    vehicle_data = st.session_state['vehicle_data']
-    trip_data = st.session_state['trip_data']
+if 'vehicle_feed' in st.session_state and 'trip_feed' in st.session_state and 'filter_ids' in st.session_state and 'fetch_time' in st.session_state:
+    vehicle_data = feed_dataframe(st.session_state['vehicle_feed'])
+    trip_data = feed_dataframe(st.session_state['trip_feed'])
+    filter_ids = st.session_state['filter_ids']
     selected_name = st.session_state['selected_name']
     fetch_time = st.session_state['fetch_time']
 
@@ -329,48 +666,37 @@ if 'vehicle_data' in st.session_state and 'trip_data' in st.session_state and 'f
         selected_value = None
 
         if filter_option == "Vehicle ID":
-            # Get available vehicle IDs to filter
-            available_vehicle_ids = set()
-            if 'vehicle_vehicle_id' in vehicle_data.columns:
-                available_vehicle_ids.update(vehicle_data['vehicle_vehicle_id'].dropna().unique())
-            sorted_vehicle_ids = smart_sort(available_vehicle_ids)
-            selected_vehicle_id = st.selectbox("Select Vehicle", [""] + sorted_vehicle_ids)
+            # Vehicle IDs sorted at load time
+            selected_vehicle_id = st.selectbox("Select Vehicle", [""] + filter_ids["Vehicle ID"])
             if selected_vehicle_id == "":
                 selected_vehicle_id = None
             selected_value = selected_vehicle_id
         elif filter_option == "Trip ID":
             # Trip ID filter
-            available_trip_ids = set()
-            if 'vehicle_trip_tripId' in vehicle_data.columns:
-                available_trip_ids.update(vehicle_data['vehicle_trip_tripId'].dropna().unique())
-            if 'tripUpdate_trip_tripId' in trip_data.columns:
-                available_trip_ids.update(trip_data['tripUpdate_trip_tripId'].dropna().unique())
-            sorted_trip_ids = smart_sort(available_trip_ids)
-            selected_trip_id = st.selectbox("Select Trip", [""] + sorted_trip_ids)
+            selected_trip_id = st.selectbox("Select Trip", [""] + filter_ids["Trip ID"])
             if selected_trip_id == "":
                 selected_trip_id = None
             selected_value = selected_trip_id
 
         elif filter_option == "Route ID":
             # Route ID filter
-            available_route_ids = set()
-            if 'vehicle_trip_routeId' in vehicle_data.columns:
-                available_route_ids.update(vehicle_data['vehicle_trip_routeId'].dropna().unique())
-            if 'tripUpdate_trip_routeId' in trip_data.columns:
-                available_route_ids.update(trip_data['tripUpdate_trip_routeId'].dropna().unique())
-            sorted_route_ids = smart_sort(available_route_ids)
-            selected_route_id = st.selectbox("Select Route", [""] + sorted_route_ids)
+            selected_route_id = st.selectbox("Select Route", [""] + filter_ids["Route ID"])
             if selected_route_id == "":
                 selected_route_id = None
             selected_value = selected_route_id
 
         # Get filtered vehicle data and trip data using the selected filters
-        filtered_vehicle_data, filtered_trip_data = get_filtered_data(
-            vehicle_data,
-            trip_data,
-            filter_option=filter_option,
-            selected_value=selected_value
-        )
+        # Without a filter the loaded frames are used as they are: get_filtered_data is st.cache_data,
+        # so calling it would unpickle a fresh copy of both frames on every rerun
+        if selected_value:
+            filtered_vehicle_data, filtered_trip_data = get_filtered_data(
+                vehicle_data,
+                trip_data,
+                filter_option=filter_option,
+                selected_value=selected_value
+            )
+        else:
+            filtered_vehicle_data, filtered_trip_data = vehicle_data, trip_data
 
         # Display the filtered data in tabs
         if not filtered_vehicle_data.empty or not filtered_trip_data.empty:
@@ -381,10 +707,10 @@ if 'vehicle_data' in st.session_state and 'trip_data' in st.session_state and 'f
 
             # Display map in the second column if vehicle data contains location information
             if not filtered_vehicle_data.empty and 'vehicle_position_latitude' in filtered_vehicle_data.columns and 'vehicle_position_longitude' in filtered_vehicle_data.columns:
-                map_obj = create_map(filtered_vehicle_data)
+                map_html = create_map(filtered_vehicle_data)
                 with col2:
                     st.write("Map View:")
-                    folium_static(map_obj, width=map_size, height=map_size)
+                    st.iframe(map_html, width=map_size, height=map_size)
             else:
                 col2.write("No vehicle positions available to display on the map.")
 
@@ -404,22 +730,24 @@ if 'vehicle_data' in st.session_state and 'trip_data' in st.session_state and 'f
                 for idx, tab in enumerate(selected_tabs):
                     with tab:
                         data = tab_contents[idx]
-                        json_list = [json.loads(item) for item in data['original_json']]
-                        json_str = json.dumps(json_list, indent=4)
+                        json_list = data['original_json'].tolist()
 
                         # Determine data type (vehicle or trip)
                         data_type = "Vehicle_Positions" if "vehicle_position_latitude" in data.columns else "Trip_Updates"
                         file_name_base = f"{selected_name}_{data_type}{'_Filtered' if selected_value else ''}_{fetch_time}".replace(" ", "_").replace(":", "-")
 
                         # Provide download buttons for JSON and XLSX data
-                        st.download_button(label=f":material/download::material/data_object: Download {data_type.replace('_', ' ')} JSON", data=json_str, file_name=f"{file_name_base}.json", mime="application/json")
-                        towrite = io.BytesIO()
-                        data.to_excel(towrite, index=False, header=True)
-                        towrite.seek(0)
-                        st.download_button(label=f":material/download::material/table: Download {data_type.replace('_', ' ')} XLSX", data=towrite, file_name=f"{file_name_base}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-
-                        # Show JSON data in a formatted manner
-                        st.json(json_list)
+                        # Both files are only serialized when their button is clicked
+                        st.download_button(label=f":material/download::material/data_object: Download {data_type.replace('_', ' ')} JSON", data=partial(orjson.dumps, json_list, option=orjson.OPT_INDENT_2), file_name=f"{file_name_base}.json", mime="application/json")
+                        st.download_button(label=f":material/download::material/table: Download {data_type.replace('_', ' ')} XLSX", data=partial(dataframe_to_xlsx, data), file_name=f"{file_name_base}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+                        # Show JSON data in a formatted manner, one page of entities at a time
+                        # (the whole feed is in the downloads above)
+                        with st.expander(f"Show raw JSON ({len(json_list)} entities)"):
+                            offset = 0
+                            if len(json_list) > json_page_size:
+                                offset = st.number_input("Offset", min_value=0, max_value=len(json_list) - 1, value=0, step=json_page_size, key=f"json_offset_{data_type}")
+                            st.json(json_list[offset:offset + json_page_size])
 
         else:
             st.write("No data available for the selected filters.")